@@ -1,7 +1,20 @@
 from flask import Flask
 from app.routes import main
+from app.extract import resume_incomplete
+from app.scheduler import get_scheduler, on_scheduler_start
 
 def create_app():
     app = Flask(__name__)
     app.register_blueprint(main)
+    # Extractions left unfinished by a previous process are resumed as soon
+    # as the Textract scheduler is created (see start_scheduler).
+    on_scheduler_start(resume_incomplete)
     return app
+
+def start_scheduler():
+    """
+    Create the Textract scheduler and resume unfinished extractions. Call
+    this only from the process that serves requests, never from the
+    Werkzeug reloader's watcher process.
+    """
+    get_scheduler()
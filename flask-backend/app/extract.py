@@ -1,9 +1,14 @@
 import boto3
-import time
+import hashlib
 import os
 import sys
+import threading
 import json
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from app import jobstate
+from app.scheduler import Reschedule, get_scheduler
 
 # Load environment variables from .env
 load_dotenv()
@@ -14,6 +19,11 @@ AWS_REGION = os.getenv("AWS_REGION", "ap-south-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "cargofl-ai-invoice-reader-test")
 S3_UPLOAD_PREFIX = "uploads"
 POLL_INTERVAL = 5  # seconds
+# Textract job statuses after which the job will not change any more.
+FINAL_JOB_STATUSES = ("SUCCEEDED", "PARTIAL_SUCCESS", "FAILED")
+
+# Returned by process_document when another worker holds the document.
+SKIPPED = "skipped"
 
 # Setup boto3 clients
 s3 = boto3.client(
@@ -23,15 +33,18 @@ s3 = boto3.client(
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY
 )
 
+# Retries are left to the scheduler so every attempt goes through its token
+# buckets and backoff; botocore's own retries would bypass both.
 textract = boto3.client(
     "textract",
     region_name=AWS_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=Config(retries={"max_attempts": 1, "mode": "standard"})
 )
 
 def list_pdf_files(bucket, user_prefix):
-    """List all PDF files under the user-specific prefix in the S3 bucket."""
+    """List (key, etag) of all PDF files under the user-specific prefix in the S3 bucket."""
     paginator = s3.get_paginator("list_objects_v2")
     pdf_files = []
 
@@ -39,19 +52,32 @@ def list_pdf_files(bucket, user_prefix):
         for obj in page.get("Contents", []):
             key = obj["Key"]
             if key.lower().endswith(".pdf"):
-                pdf_files.append(key)
+                pdf_files.append((key, obj["ETag"]))
 
     return pdf_files
 
-def start_table_detection(bucket, key):
-    resp = textract.start_document_analysis(
+def client_request_token(bucket, key, etag, previous_job_id=None):
+    """
+    Idempotency token for start_document_analysis. Textract returns the same
+    JobId when a start is repeated with the same token, so a crash before the
+    JobId is persisted does not start (and bill) a second job. A retry after
+    a failed or expired job passes that job's id to get a new token.
+    """
+    seed = f"{bucket}/{key}/{etag}/{previous_job_id or ''}"
+    return hashlib.sha256(seed.encode("utf-8")).hexdigest()
+
+def start_table_detection(bucket, key, etag, previous_job_id=None):
+    resp = get_scheduler().call(
+        "start",
+        textract.start_document_analysis,
         DocumentLocation={"S3Object": {"Bucket": bucket, "Name": key}},
-        FeatureTypes=["TABLES"]
+        FeatureTypes=["TABLES"],
+        ClientRequestToken=client_request_token(bucket, key, etag, previous_job_id)
     )
     return resp["JobId"]
 
 def is_job_complete(job_id):
-    resp = textract.get_document_analysis(JobId=job_id)
+    resp = get_scheduler().call("get", textract.get_document_analysis, JobId=job_id)
     return resp["JobStatus"], resp
 
 def get_all_results(job_id):
@@ -59,9 +85,9 @@ def get_all_results(job_id):
     next_token = None
     while True:
         if next_token:
-            resp = textract.get_document_analysis(JobId=job_id, NextToken=next_token)
+            resp = get_scheduler().call("get", textract.get_document_analysis, JobId=job_id, NextToken=next_token)
         else:
-            resp = textract.get_document_analysis(JobId=job_id)
+            resp = get_scheduler().call("get", textract.get_document_analysis, JobId=job_id)
         pages.append(resp)
         next_token = resp.get("NextToken")
         if not next_token:
@@ -122,24 +148,116 @@ def delete_file_from_s3(bucket, key):
     try:
         s3.delete_object(Bucket=bucket, Key=key)
         print(f"[INFO] Deleted file from S3: {key}")
+        return True
     except Exception as e:
         print(f"[ERROR] Failed to delete {key} from S3: {e}")
+        return False
 
-def process_document(bucket, key, doc_index):
-    print(f"[INFO] Starting Textract TABLE analysis for {key}...")
-    job_id = start_table_detection(bucket, key)
-    print(f"[INFO] Job started. JobId: {job_id}")
+def is_expired_job_error(error):
+    """Textract forgets JobIds after a few days; those jobs must be restarted."""
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") == "InvalidJobIdException"
+    )
 
-    while True:
-        status, resp = is_job_complete(job_id)
-        print(f"[INFO] Job status for {key}: {status}")
-        if status in ("SUCCEEDED", "FAILED"):
-            break
-        time.sleep(POLL_INTERVAL)
+def is_job_limit_error(error):
+    """The account has reached Textract's limit on concurrent async jobs."""
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") == "LimitExceededException"
+    )
+
+def process_document(bucket, key, etag, resume=False):
+    """
+    Claim a document and run its next extraction steps. Documents another
+    worker holds a claim on are skipped, except when resuming after a
+    restart: the claim may still be held by this worker's previous process,
+    so wait for its lease to run out instead.
+
+    Returns SKIPPED if the document was left to another worker. Raises if
+    the Textract job failed.
+    """
+    state = jobstate.claim(bucket, key, etag, restart_finished=not resume)
+    if state is None:
+        if resume:
+            return Reschedule(POLL_INTERVAL)
+        print(f"[INFO] {key} is being extracted by another worker, skipping.")
+        return SKIPPED
+
+    try:
+        result = run_document_steps(bucket, key, etag, state)
+    except Exception:
+        jobstate.release(bucket, key)
+        raise
+    # Keep the claim across polls; the next run renews it.
+    if not isinstance(result, Reschedule):
+        jobstate.release(bucket, key)
+    return result
+
+def run_document_steps(bucket, key, etag, state):
+    """
+    Run the next extraction steps for one document, recording each finished
+    step in the job state store. If a previous run was interrupted, pick up
+    after the last recorded step and re-attach to its Textract JobId instead
+    of starting a new job.
+
+    While the Textract job is running this returns `Reschedule` so the
+    scheduler polls it again later instead of sleeping in a worker.
+    """
+    status = state["status"]
+    job_id = state["job_id"]
+    tables = state["tables"]
+
+    if status == jobstate.STARTED:
+        try:
+            job_status, resp = is_job_complete(job_id)
+            print(f"[INFO] Job status for {key}: {job_status}")
+            if job_status not in FINAL_JOB_STATUSES:
+                return Reschedule(POLL_INTERVAL)
+        except ClientError as e:
+            if not is_expired_job_error(e):
+                raise
+            print(f"[WARN] JobId {job_id} for {key} has expired, restarting.")
+            jobstate.restart(bucket, key, job_id)
+            status = jobstate.QUEUED
+
+    if status == jobstate.QUEUED:
+        print(f"[INFO] Starting Textract TABLE analysis for {key}...")
+        # After a failed or expired job the row keeps the old JobId, giving
+        # the retry its own idempotency token.
+        try:
+            job_id = start_table_detection(bucket, key, etag, previous_job_id=job_id)
+        except ClientError as e:
+            if not is_job_limit_error(e):
+                raise
+            # Too many open Textract jobs; retry once running ones finish.
+            print(f"[WARN] Textract job limit reached, delaying {key}.")
+            return Reschedule(POLL_INTERVAL)
+        jobstate.mark_started(bucket, key, job_id)
+        print(f"[INFO] Job started. JobId: {job_id}")
+        return Reschedule(POLL_INTERVAL)
+
+    if status == jobstate.STARTED:
+        if job_status == "FAILED":
+            print(f"[ERROR] Textract job failed for {key}: {resp}")
+            message = resp.get("StatusMessage", job_status)
+            jobstate.mark_failed(bucket, key, job_id, message)
+            raise RuntimeError(f"Textract job {job_id} failed: {message}")
+
+        warning = None
+        if job_status == "PARTIAL_SUCCESS":
+            # Some pages could not be analysed; keep the tables we did get.
+            warning = resp.get("StatusMessage") or "; ".join(
+                f"{w.get('ErrorCode')} on pages {w.get('Pages')}" for w in resp.get("Warnings", [])
+            ) or "Textract returned partial results"
+            print(f"[WARN] Textract job for {key} partially succeeded: {warning}")
 
-    if status == "SUCCEEDED":
         pages = get_all_results(job_id)
         tables = extract_tables(pages)
+        jobstate.mark_results_fetched(bucket, key, job_id, tables, warning=warning)
+        status = jobstate.RESULTS_FETCHED
+
+    if status == jobstate.RESULTS_FETCHED:
         if not tables:
             print(f"[WARN] No tables found in document: {key}")
         else:
@@ -154,31 +272,123 @@ def process_document(bucket, key, doc_index):
                 filename = f"{pdf_filename}_{idx + 1}.json"
                 save_table_to_json_and_upload(table, bucket, user_prefix, filename)
 
+        jobstate.mark_tables_written(bucket, key, job_id, tables)
+        status = jobstate.TABLES_WRITTEN
+
+    if status == jobstate.TABLES_WRITTEN:
         # Delete original PDF after successful extraction
-        delete_file_from_s3(bucket, key)
-    else:
-        print(f"[ERROR] Textract job failed for {key}: {resp}")
+        if delete_file_from_s3(bucket, key):
+            jobstate.mark_source_deleted(bucket, key, job_id)
+
+_in_flight = {}  # (bucket, key) -> Future of the queued process_document
+_in_flight_lock = threading.Lock()
+
+def submit_document(user_id, bucket, key, etag, resume=False):
+    """
+    Queue a document on the scheduler unless it is already queued or running
+    in this process, in which case the existing Future is returned.
+    """
+    with _in_flight_lock:
+        future = _in_flight.get((bucket, key))
+        if future is not None and not future.done():
+            return future
+        future = get_scheduler().submit(user_id, process_document, bucket, key, etag, resume)
+        _in_flight[(bucket, key)] = future
+
+    def forget(done):
+        with _in_flight_lock:
+            if _in_flight.get((bucket, key)) is done:
+                del _in_flight[(bucket, key)]
+
+    future.add_done_callback(forget)
+    return future
+
+def get_object_etag(bucket, key):
+    """Return the current ETag of an S3 object, or None if it is gone."""
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+def resume_incomplete():
+    """
+    Resubmit documents a previous process left unfinished, so in-flight
+    Textract jobs are re-attached before their JobIds expire.
+    """
+    for state in jobstate.incomplete_documents():
+        try:
+            resume_document(state)
+        except Exception as e:
+            print(f"[ERROR] Failed to resume extraction of {state['doc_key']}: {e}")
+
+def resume_document(state):
+    bucket, key = state["bucket"], state["doc_key"]
+    current_etag = get_object_etag(bucket, key)
+
+    if current_etag is None:
+        if state["status"] == jobstate.TABLES_WRITTEN:
+            # Crashed after deleting the PDF but before recording it.
+            jobstate.mark_source_deleted(bucket, key, state["job_id"])
+        else:
+            jobstate.mark_failed(bucket, key, state["job_id"], "Source PDF no longer exists")
+        return
+
+    if current_etag != state["etag"]:
+        # Re-uploaded since; the next extract call treats it as new.
+        return
+
+    # Keys look like uploads/<user_id>/<file>.pdf
+    parts = key.split("/")
+    user_id = parts[1] if len(parts) > 2 and parts[0] == S3_UPLOAD_PREFIX else key
+    print(f"[INFO] Resuming extraction of {key} from step {state['status']}.")
+    submit_document(user_id, bucket, key, state["etag"], resume=True)
+
+def extract_for_user(user_id):
+    """
+    Queue every PDF under the user's prefix on the shared Textract scheduler
+    and wait for them. Returns (processed_keys, skipped_keys, errors), where
+    skipped keys are still being extracted by another worker.
+    """
+    user_prefix = f"{S3_UPLOAD_PREFIX}/{user_id}/"
+    pdf_files = list_pdf_files(S3_BUCKET, user_prefix)
+    if not pdf_files:
+        print(f"[INFO] No PDF files found in S3 bucket for user {user_id}.")
+        return [], [], []
+
+    futures = [
+        (pdf_key, submit_document(user_id, S3_BUCKET, pdf_key, etag))
+        for pdf_key, etag in pdf_files
+    ]
+
+    processed = []
+    skipped = []
+    errors = []
+    for pdf_key, future in futures:
+        try:
+            if future.result() == SKIPPED:
+                skipped.append(pdf_key)
+            else:
+                processed.append(pdf_key)
+        except Exception as e:
+            print(f"[ERROR] Extraction failed for {pdf_key}: {e}")
+            errors.append(f"Failed to extract {pdf_key}: {str(e)}")
+
+    return processed, skipped, errors
 
 def main(user_id=None):
     if not user_id:
         print("[ERROR] User ID is required to scope files for extraction.")
         return
 
-    user_prefix = f"{S3_UPLOAD_PREFIX}/{user_id}/"
     try:
-        pdf_files = list_pdf_files(S3_BUCKET, user_prefix)
-        if not pdf_files:
-            print(f"[INFO] No PDF files found in S3 bucket for user {user_id}.")
-            return
-
-        for i, pdf_key in enumerate(pdf_files, 1):
-            process_document(S3_BUCKET, pdf_key, i)
-
+        extract_for_user(user_id)
     except Exception as e:
         print(f"[FATAL] Unexpected error: {e}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python extract.py <user_id>")
+        print("Usage: python -m app.extract <user_id>")
     else:
         main(sys.argv[1])
@@ -0,0 +1,215 @@
+# jobstate.py
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOB_STATE_DB = os.getenv(
+    "JOB_STATE_DB",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "job_state.db")
+)
+
+# A worker claims a document before working on it. The claim expires after
+# JOB_LEASE_SECONDS so a crashed worker's documents can be picked up again;
+# every step renews it.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Per-document extraction steps, in order. A document that is restarted
+# resumes from the step after the last one recorded here.
+QUEUED = "queued"
+STARTED = "started"
+RESULTS_FETCHED = "results_fetched"
+TABLES_WRITTEN = "tables_written"
+SOURCE_DELETED = "source_deleted"
+FAILED = "failed"
+
+TERMINAL_STATES = {SOURCE_DELETED, FAILED}
+
+job_state_ddl = """
+CREATE TABLE IF NOT EXISTS extraction_jobs (
+    bucket TEXT NOT NULL,
+    doc_key TEXT NOT NULL,
+    etag TEXT,
+    status TEXT NOT NULL,
+    job_id TEXT,
+    tables TEXT,
+    error TEXT,
+    owner TEXT,
+    lease_until REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (bucket, doc_key)
+)
+"""
+
+_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    conn = sqlite3.connect(JOB_STATE_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        conn.execute(job_state_ddl)
+        conn.commit()
+        _initialized = True
+    return conn
+
+
+def get_state(bucket, key):
+    """Return the persisted state of a document as a dict, or None."""
+    with _lock:
+        conn = _connect()
+        try:
+            row = conn.execute(
+                "SELECT * FROM extraction_jobs WHERE bucket = ? AND doc_key = ?",
+                (bucket, key)
+            ).fetchone()
+        finally:
+            conn.close()
+
+    if row is None:
+        return None
+    state = dict(row)
+    state["tables"] = json.loads(state["tables"]) if state["tables"] else None
+    return state
+
+
+def _save(bucket, key, status, job_id=None, tables=None, error=None):
+    # `error` also holds warnings (e.g. partial results), so it is kept
+    # through later steps unless a new one is given.
+    with _lock:
+        conn = _connect()
+        try:
+            conn.execute(
+                "UPDATE extraction_jobs"
+                " SET status = ?, job_id = ?, tables = ?, error = COALESCE(?, error), updated_at = ?"
+                " WHERE bucket = ? AND doc_key = ?",
+                (status, job_id,
+                 json.dumps(tables) if tables is not None else None,
+                 error, time.time(), bucket, key)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def claim(bucket, key, etag, owner=WORKER_ID, restart_finished=True):
+    """
+    Atomically claim a document for `owner` and return its state, or None
+    if another worker holds an unexpired claim. A claim we already hold is
+    renewed.
+
+    A new key, a different `etag` (the PDF was re-uploaded under the same
+    name) or, with `restart_finished`, a finished document starts over at
+    QUEUED. For the same etag the previous JobId is kept, so the new start
+    gets a different request token instead of Textract handing back the
+    previous (e.g. FAILED) job.
+    """
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR IGNORE INTO extraction_jobs"
+                " (bucket, doc_key, etag, status, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (bucket, key, etag, QUEUED, now)
+            )
+            claimed = conn.execute(
+                "UPDATE extraction_jobs SET owner = ?, lease_until = ?"
+                " WHERE bucket = ? AND doc_key = ?"
+                " AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+                (owner, now + JOB_LEASE_SECONDS, bucket, key, owner, now)
+            ).rowcount
+            if not claimed:
+                conn.rollback()
+                return None
+
+            row = conn.execute(
+                "SELECT * FROM extraction_jobs WHERE bucket = ? AND doc_key = ?",
+                (bucket, key)
+            ).fetchone()
+            if row["etag"] != etag or (restart_finished and row["status"] in TERMINAL_STATES):
+                previous_job_id = row["job_id"] if row["etag"] == etag else None
+                conn.execute(
+                    "UPDATE extraction_jobs"
+                    " SET etag = ?, status = ?, job_id = ?, tables = NULL, error = NULL, updated_at = ?"
+                    " WHERE bucket = ? AND doc_key = ?",
+                    (etag, QUEUED, previous_job_id, now, bucket, key)
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    return get_state(bucket, key)
+
+
+def incomplete_documents():
+    """Return the states of all documents not in a terminal state."""
+    with _lock:
+        conn = _connect()
+        try:
+            rows = conn.execute(
+                "SELECT bucket, doc_key, etag, status, job_id FROM extraction_jobs"
+                " WHERE status NOT IN (?, ?)",
+                tuple(TERMINAL_STATES)
+            ).fetchall()
+        finally:
+            conn.close()
+    return [dict(row) for row in rows]
+
+
+def release(bucket, key, owner=WORKER_ID):
+    """Give up a claim so other workers may pick the document up."""
+    with _lock:
+        conn = _connect()
+        try:
+            conn.execute(
+                "UPDATE extraction_jobs SET owner = NULL, lease_until = NULL"
+                " WHERE bucket = ? AND doc_key = ? AND owner = ?",
+                (bucket, key, owner)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def restart(bucket, key, previous_job_id):
+    """
+    Send a tracked document back to the first step, keeping its etag. The
+    previous JobId is kept so the new start gets a different request token.
+    """
+    _save(bucket, key, QUEUED, job_id=previous_job_id)
+
+
+def mark_started(bucket, key, job_id):
+    _save(bucket, key, STARTED, job_id=job_id)
+
+
+def mark_results_fetched(bucket, key, job_id, tables, warning=None):
+    _save(bucket, key, RESULTS_FETCHED, job_id=job_id, tables=tables, error=warning)
+
+
+def mark_tables_written(bucket, key, job_id, tables):
+    _save(bucket, key, TABLES_WRITTEN, job_id=job_id, tables=tables)
+
+
+def mark_source_deleted(bucket, key, job_id):
+    # Tables are already in S3, no need to keep a copy around.
+    _save(bucket, key, SOURCE_DELETED, job_id=job_id)
+
+
+def mark_failed(bucket, key, job_id, error):
+    _save(bucket, key, FAILED, job_id=job_id, error=error)
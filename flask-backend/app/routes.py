@@ -2,8 +2,8 @@ from flask import Blueprint, request, jsonify
 from flask_cors import CORS
 from app.upload import upload_files_to_s3
 from app import finalize
-import subprocess
-import sys
+from app.extract import extract_for_user
+from app.scheduler import get_scheduler
 import os
 import json
 import boto3
@@ -67,34 +67,35 @@ def upload_files():
 def extract():
     try:
         data = request.get_json(silent=True) or {}
-        filenames = data.get("filenames")
         user_id = data.get("user_id")
 
         if not user_id:
             return jsonify({"error": "user_id not provided"}), 400
 
-        args = [user_id]
+        # Documents are queued on the shared Textract scheduler so concurrent
+        # users share the Textract TPS quota fairly.
+        processed, skipped, errors = extract_for_user(user_id)
 
-        if filenames:
-            args.append(json.dumps(filenames))
+        if not processed and not skipped and errors:
+            return jsonify({"error": "Extraction failed", "details": errors}), 500
 
-        extract_script = os.path.join(os.path.dirname(__file__), "extract.py")
+        response = {"message": "Extraction completed", "processed_keys": processed}
+        if skipped:
+            # Another worker is still extracting these.
+            response["skipped_keys"] = skipped
+        if errors:
+            response["errors"] = errors
 
-        result = subprocess.run(
-            [sys.executable, extract_script, *args],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        return jsonify(response), 207 if errors else 200
 
-        print("[extract.py output]")
-        print(result.stdout)
+    except Exception as e:
+        print(f"[ERROR] Extract failed: {e}")
+        return jsonify({"error": "Extraction failed", "details": str(e)}), 500
 
-        return jsonify({"message": "Extraction started", "output": result.stdout}), 200
 
-    except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Extract failed: {e.stderr}")
-        return jsonify({"error": "Extraction failed", "details": e.stderr}), 500
+@main.route('/api/invoices/extract/metrics', methods=['GET'])
+def extract_metrics():
+    return jsonify(get_scheduler().metrics()), 200
 
 
 @main.route('/api/invoices/finalize', methods=['GET'])
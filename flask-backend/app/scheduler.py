@@ -0,0 +1,315 @@
+# scheduler.py
+"""
+Process-wide Textract scheduler.
+
+The token buckets and user queues live in memory, so the TPS limits are only
+enforced within one process. Run the backend as a single process (e.g.
+gunicorn with `--workers 1 --threads N`); with several WSGI worker
+processes each one gets its own limits and the account-wide quota is
+exceeded.
+"""
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Textract TPS quotas (per account/region). Defaults match the AWS defaults
+# for StartDocumentAnalysis and GetDocumentAnalysis in most regions.
+TEXTRACT_START_TPS = float(os.getenv("TEXTRACT_START_TPS", "2"))
+TEXTRACT_GET_TPS = float(os.getenv("TEXTRACT_GET_TPS", "10"))
+# Workers only run individual steps (start a job, poll it once, write its
+# tables) and never sleep on a running job, so they bound concurrent calls,
+# not the number of documents in flight. Sized to cover both buckets by default.
+TEXTRACT_MAX_WORKERS = int(os.getenv(
+    "TEXTRACT_MAX_WORKERS", str(max(4, int(TEXTRACT_START_TPS + TEXTRACT_GET_TPS)))
+))
+TEXTRACT_MAX_RETRIES = int(os.getenv("TEXTRACT_MAX_RETRIES", "6"))
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 20  # seconds
+
+# LimitExceededException is not a TPS throttle: it means the account has too
+# many open async jobs, which only finishing jobs can fix. Callers handle it.
+THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+}
+
+
+class Reschedule:
+    """
+    Returned by a task to run it again after `delay` seconds, e.g. to poll a
+    Textract job later without holding a worker while it runs.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Server-side errors botocore would normally retry for us.
+TRANSIENT_ERROR_CODES = {
+    "InternalServerError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+
+def is_throttling_error(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    )
+
+
+def is_transient_error(error):
+    """5xx responses and connection/endpoint errors that are worth retrying."""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return status >= 500 or error.response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+class TextractScheduler:
+    """
+    Central scheduler for Textract work shared by all users.
+
+    Every Textract call goes through `call()`, which enforces a token bucket
+    per API ("start", "get") and retries throttling and transient errors
+    with jittered backoff (botocore's own retries are turned off). Documents are queued per user with `submit()` and a fixed pool
+    of workers serves the user queues round-robin, so one user with a large
+    batch cannot starve the others. A task that returns `Reschedule` goes
+    back to the front of its user's queue once the delay has passed, keeping
+    its Future, so polls of running jobs are served before new starts.
+    """
+
+    def __init__(self, start_tps=TEXTRACT_START_TPS, get_tps=TEXTRACT_GET_TPS,
+                 max_workers=TEXTRACT_MAX_WORKERS, max_retries=TEXTRACT_MAX_RETRIES):
+        self.buckets = {
+            "start": TokenBucket(start_tps),
+            "get": TokenBucket(get_tps),
+        }
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.queues = OrderedDict()  # user_id -> deque of (enqueued_at, fn, args, future)
+        self.delayed = []  # heap of (due_at, seq, user_id, fn, args, future)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.workers = []
+        self.stats = {
+            "throttled": 0,
+            "transient_errors": 0,
+            "completed": 0,
+            "failed": 0,
+            "rescheduled": 0,
+            "wait_count": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+        self.user_stats = {}
+
+    def call(self, api, fn, *args, **kwargs):
+        """Call a Textract API under its rate limit, retrying throttling and transient errors."""
+        bucket = self.buckets[api]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    reason = "throttled"
+                elif is_transient_error(e):
+                    reason = "transient_errors"
+                else:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                with self.cond:
+                    self.stats[reason] += 1
+                delay = backoff_delay(attempt)
+                print(f"[WARN] Textract {api} failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def submit(self, user_id, fn, *args):
+        """Queue `fn(*args)` on behalf of `user_id` and return a Future."""
+        future = Future()
+        with self.cond:
+            self._ensure_workers()
+            self.queues.setdefault(user_id, deque()).append((time.monotonic(), fn, args, future))
+            self.cond.notify()
+        return future
+
+    def _ensure_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _release_due(self):
+        """Move delayed tasks that are due to the front of their user queues."""
+        now = time.monotonic()
+        due = OrderedDict()
+        while self.delayed and self.delayed[0][0] <= now:
+            due_at, _, user_id, fn, args, future = heapq.heappop(self.delayed)
+            due.setdefault(user_id, []).append((due_at, fn, args, future))
+        for user_id, tasks in due.items():
+            # extendleft reverses, so keep the due tasks in due order.
+            self.queues.setdefault(user_id, deque()).extendleft(reversed(tasks))
+
+    def _next_task(self):
+        # Take the head of the first user's queue, then rotate that user to
+        # the back so the next worker serves somebody else.
+        user_id, queue = next(iter(self.queues.items()))
+        task = queue.popleft()
+        if queue:
+            self.queues.move_to_end(user_id)
+        else:
+            del self.queues[user_id]
+        return user_id, task
+
+    def _record_wait(self, user_id, waited):
+        self.stats["wait_count"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        user = self.user_stats.setdefault(user_id, {"wait_count": 0, "wait_total": 0.0, "wait_max": 0.0})
+        user["wait_count"] += 1
+        user["wait_total"] += waited
+        user["wait_max"] = max(user["wait_max"], waited)
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                self._release_due()
+                while not self.queues:
+                    timeout = self.delayed[0][0] - time.monotonic() if self.delayed else None
+                    self.cond.wait(timeout)
+                    self._release_due()
+                user_id, (enqueued_at, fn, args, future) = self._next_task()
+                self._record_wait(user_id, time.monotonic() - enqueued_at)
+
+            # Rescheduled tasks already hold a running Future.
+            if not future.running() and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+                if isinstance(result, Reschedule):
+                    due_at = time.monotonic() + result.delay
+                    with self.cond:
+                        heapq.heappush(self.delayed, (due_at, next(self.sequence), user_id, fn, args, future))
+                        self.stats["rescheduled"] += 1
+                        self.cond.notify()
+                    continue
+                future.set_result(result)
+                outcome = "completed"
+            except Exception as e:
+                future.set_exception(e)
+                outcome = "failed"
+            with self.cond:
+                self.stats[outcome] += 1
+
+    def metrics(self):
+        """Snapshot of queue depths, wait times and throttling counts."""
+        with self.cond:
+            now = time.monotonic()
+            queues = {
+                user_id: {
+                    "depth": len(queue),
+                    "oldest_wait": round(now - min(task[0] for task in queue), 3),
+                }
+                for user_id, queue in self.queues.items()
+            }
+            delayed = len(self.delayed)
+            stats = dict(self.stats)
+            wait_count = stats.pop("wait_count")
+            wait_total = stats.pop("wait_total")
+            users = {
+                user_id: {
+                    "dispatched": s["wait_count"],
+                    "avg_wait": round(s["wait_total"] / s["wait_count"], 3),
+                    "max_wait": round(s["wait_max"], 3),
+                }
+                for user_id, s in self.user_stats.items()
+            }
+        return {
+            "workers": len(self.workers),
+            "queue_depth": sum(q["depth"] for q in queues.values()),
+            "delayed": delayed,
+            "queues": queues,
+            "dispatched": wait_count,
+            "avg_wait": round(wait_total / wait_count, 3) if wait_count else 0.0,
+            "max_wait": round(stats.pop("wait_max"), 3),
+            "users": users,
+            **stats,
+        }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_startup_hooks = []
+
+
+def on_scheduler_start(hook):
+    """Register `hook()` to run once, right after the scheduler is created."""
+    if hook not in _startup_hooks:
+        _startup_hooks.append(hook)
+
+
+def get_scheduler():
+    """Return the process-wide Textract scheduler (one per process, see module docstring)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            return _scheduler
+        _scheduler = TextractScheduler()
+
+    # Hooks may submit work, which calls back into get_scheduler().
+    for hook in _startup_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"[ERROR] Scheduler startup hook {hook.__name__} failed: {e}")
+    return _scheduler
@@ -1,6 +1,13 @@
-from app import create_app
+from werkzeug.serving import is_running_from_reloader
+from app import create_app, start_scheduler
 
 app = create_app()
 
+# With debug=True this file runs twice: in the reloader's watcher process and
+# in the child that serves requests. Only the child (or a WSGI server that
+# imports `run:app`) may own the Textract scheduler.
+if __name__ != "__main__" or is_running_from_reloader():
+    start_scheduler()
+
 if __name__ == "__main__":
     app.run(debug=True)